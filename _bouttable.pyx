@@ -0,0 +1,69 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# distutils: language = c++
+#
+# Compiled prefix counting for bouttablestats.py. It is used instead of the
+# Numba and pure Python versions if it has been built, e.g. with:
+#
+#   cythonize -i _bouttable.pyx
+
+import numpy as np
+
+from cython.operator cimport dereference as deref
+from libc.stdint cimport int64_t, uint64_t
+from libcpp.unordered_map cimport unordered_map
+
+ctypedef fused behavior_t:
+    signed char
+    short
+
+# Prefixes are keyed by their parent prefix in the upper and their last
+# behavior in the lower 32 bits, which is exact below this number of elements
+cdef uint64_t MAX_KERNEL_SIZE = 1ULL << 32
+
+def count_prefixes(const behavior_t[:, :] bouts, behavior_t sentinel):
+    """Count all prefixes of the <sentinel> terminated bouts in the <bouts>
+    matrix. Each prefix is identified by its parent prefix and its last
+    behavior, which are combined into a 64-bit key. Raises a ValueError if the
+    matrix has too many elements for exact keys. Returns three arrays that
+    contain for each prefix its count, the index of its parent prefix (-1 for
+    the root) and its last behavior. The GIL is released while counting."""
+    # There can't be more prefixes than bout elements
+    n = bouts.shape[0] * bouts.shape[1]
+    if <uint64_t>n >= MAX_KERNEL_SIZE:
+        raise ValueError("Bout matrix is too large for exact prefix keys")
+    counts = np.zeros(n, dtype=np.int64)
+    parents = np.empty(n, dtype=np.int64)
+    symbols = np.empty(n, dtype=np.int64)
+
+    cdef int64_t[::1] counts_view = counts
+    cdef int64_t[::1] parents_view = parents
+    cdef int64_t[::1] symbols_view = symbols
+    cdef unordered_map[uint64_t, int64_t] nodes
+    cdef unordered_map[uint64_t, int64_t].iterator found
+    cdef Py_ssize_t i, j
+    cdef int64_t node, parent
+    cdef int64_t n_nodes = 0
+    cdef uint64_t key
+    cdef behavior_t v
+
+    with nogil:
+        for i in range(bouts.shape[0]):
+            parent = -1
+            for j in range(bouts.shape[1]):
+                v = bouts[i, j]
+                if v == sentinel:
+                    break
+                key = (<uint64_t>(parent + 1) << 32) | <unsigned int>v
+                found = nodes.find(key)
+                if found == nodes.end():
+                    node = n_nodes
+                    nodes[key] = node
+                    parents_view[node] = parent
+                    symbols_view[node] = v
+                    n_nodes += 1
+                else:
+                    node = deref(found).second
+                counts_view[node] += 1
+                parent = node
+
+    return counts[:n_nodes], parents[:n_nodes], symbols[:n_nodes]
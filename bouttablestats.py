@@ -15,118 +15,124 @@
 import argparse
 import csv
 import logging
+import os
 import pprint
+import sys
 import networkx as nx
-
-from itertools import groupby
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import _bouttable
+except ImportError:
+    _bouttable = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pac
+except ImportError:
+    pa = None
+    pc = None
+    pac = None
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import chain, groupby, islice
+from operator import itemgetter
 
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
-class BoutStatistics(object):
-
-    def __init__(self, s, p, path, offset=0, begin_with_stimuli=False,
-            delim=';', nheadrows=0, nomerge=False, max_rows=None, bout_file=None):
-
-        self.begin_with_stimuli = begin_with_stimuli
+# Marks unused bout columns in integer bout matrices, e.g. after merging
+SENTINEL = -1
 
-        logger.info("Creating pattern histograms beginning with {} bout in file: {}" \
-            .format('stimuli' if begin_with_stimuli else 'pause', path))
-        logger.info("Stimuli bout length: {} Pause bout length: {}".format(s, p))
-
-        # Load CSV and collect stimuli and pause bouts
-        head_rows = []
-        raw_stimuli = []
-        raw_pauses = []
-        boutcsv = []
-        with open(path, 'r') as csvfile:
-            linereader = csv.reader(csvfile, delimiter=delim)
-            stimuli_bout = begin_with_stimuli
-            current_loc = offset
-            bout_label = "Bout" if nomerge else "Bout (merged)"
-
-            for n, row in enumerate(linereader):
-                if n < nheadrows:
-                    head_rows.append(row)
-                    continue
-                if max_rows and n + nheadrows >= max_rows:
-                    logger.info("Reached row limit of {} rows".format(max_rows))
-                    break
+# Number of rows of text tables that are read before their bouts are counted
+CHUNK_ROWS = 100000
 
-                # Prepare bout copying, if enabled
-                if bout_file:
-                    copy_target = []
-                    boutcsv.append(copy_target)
-                else:
-                    copy_target = None
+# Minimum number of bouts counted by each thread
+CHUNK_BOUTS = 100000
 
-                # Collect all bouts
-                n_stimuli_bouts = 0
-                n_pause_bouts = 0
-                logger.debug("Row: {}".format(row))
-                while True:
-                    start = offset + s * n_stimuli_bouts + p * n_pause_bouts
-                    length = s if stimuli_bout else p
-                    raw_bout = row[start:(start + length)]
-
-                    # Merge adjacent bout elements if they are the same, if not disabled
-                    bout = raw_bout if nomerge else [k for k,v in groupby(raw_bout)]
-                    bout_alias = "S" if stimuli_bout else "P"
-                    logger.debug("{}: Bout start: {} bound end: {} {}: {}" \
-                            .format(bout_alias, start, start + length - 1, bout_label, ",".join(bout)))
+# Size in bytes of the blocks in which PyArrow parses CSV files
+ARROW_BLOCK_SIZE = 1 << 24
 
-                    # If we can't get enough content anymore, stop
-                    if length != len(raw_bout):
-                        break
+# Number of bout positions that are counted vectorized if Numba isn't available
+SHALLOW_DEPTH = 2
 
-                    if stimuli_bout:
-                        raw_stimuli.append(bout)
-                        n_stimuli_bouts += 1
-                    else:
-                        raw_pauses.append(bout)
-                        n_pause_bouts += 1
+# Record of a node in a flattened prefix trie: its count, the index and number
+# of its children and the index of its behavior in a list of labels
+TRIE_NODE = np.dtype([('count', np.int64), ('first', np.int32),
+        ('nchild', np.int32), ('label', np.int32)])
 
-                    if bout_file:
-                        bout_copy = bout if nomerge else pad_bout(bout, length)
-                        copy_target.append(bout_copy)
+# Compiled prefix counting identifies a prefix by the id of its parent prefix
+# in the upper and its last behavior in the lower half of a 64-bit key. This
+# is exact as long as a bout matrix has less elements than MAX_KERNEL_SIZE.
+MAX_KERNEL_SIZE = 1 << 32
 
-                    stimuli_bout = not stimuli_bout
+class BoutStatistics(object):
 
-        logger.info("Found {} stimuli bouts in total".format(len(raw_stimuli)))
-        logger.info("Found {} pause bouts in total".format(len(raw_pauses)))
+    def __init__(self, s, p, path, offset=0, begin_with_stimuli=False,
+            delim=';', nheadrows=0, nomerge=False, max_rows=None, bout_file=None,
+            text=False, marginal=False):
 
-        # Build stimuli and pause histograms. Each histogram is a list of
-        # bout positions. Each bout position is a dictionary mapping a
-        # seen value to the number of times it has been seen in the list of
-        # bouts.
-        self.stimuli_histogram = make_histogram(raw_stimuli)
-        self.pause_histogram = make_histogram(raw_pauses)
+        self.begin_with_stimuli = begin_with_stimuli
 
-        self.stimuli_ptree = percentage_tree(self.stimuli_histogram)
-        self.pause_ptree = percentage_tree(self.pause_histogram)
+        logger.info("Creating pattern histograms beginning with {} bout in file: {}" \
+            .format('stimuli' if begin_with_stimuli else 'pause', path))
+        logger.info("Stimuli bout length: {} Pause bout length: {}".format(s, p))
 
-        logger.info("Stimuli histogram: \n{}".format(format_histogram(self.stimuli_ptree)))
-        logger.info("Pause histogram: \n{}".format(format_histogram(self.pause_ptree)))
+        # Build stimuli and pause histograms. Each histogram is a prefix trie,
+        # counting for each bout prefix (a sequence of behaviors) the number
+        # of times it has been seen in the list of bouts. Bouts are counted
+        # chunk by chunk while they are loaded. If only marginal histograms are
+        # wanted, each histogram is a list of behavior counts per position.
+        bout_chunks = load_bouts(s, p, path, offset, begin_with_stimuli, delim,
+                nheadrows, nomerge, max_rows, bout_file, text)
+        self.stimuli_histogram, self.pause_histogram, n_stimuli, n_pauses = \
+                build_histograms(bout_chunks, marginal)
+
+        logger.info("Found {} stimuli bouts in total".format(n_stimuli))
+        logger.info("Found {} pause bouts in total".format(n_pauses))
+
+        if marginal:
+            self.stimuli_ptree = None
+            self.pause_ptree = None
+            self.stimuli_marginals = marginal_percentages(self.stimuli_histogram)
+            self.pause_marginals = marginal_percentages(self.pause_histogram)
+            stimuli_result = self.stimuli_marginals
+            pause_result = self.pause_marginals
+        else:
+            self.stimuli_ptree = percentage_tree(self.stimuli_histogram)
+            self.pause_ptree = percentage_tree(self.pause_histogram)
+            stimuli_result = self.stimuli_ptree
+            pause_result = self.pause_ptree
 
-        if bout_file:
-            logger.info("Writing bout CSV file")
-            # If wanted, write out the merged bouts, padded to match the original
-            # column counts.
-            with open(bout_file, 'w') as boutcsvfile:
-                for bouts in boutcsv:
-                    columns = [v for b in bouts for v in b]
-                    line = delim.join(columns)
-                    boutcsvfile.write(line)
-                    boutcsvfile.write("\n")
+        # Formatting whole trees is expensive, only do it if they are logged
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Stimuli histogram: \n{}".format(format_histogram(stimuli_result)))
+            logger.info("Pause histogram: \n{}".format(format_histogram(pause_result)))
 
     def get_nx_graphs(self):
         """Build NetworkX graph data structures for bot stimuli and pause
         graphs.
         """
+        if self.stimuli_ptree is None:
+            raise ValueError("Graphs can only be built from prefix histograms")
+
         def add_nodes(graph, nodes, parent, prefix=""):
             for e,p in nodes.items():
-                name = prefix + e
+                name = prefix + str(e)
                 graph.add_node(name, frequency=p['percent'], count=p['count'])
                 graph.add_edge(parent, name)
 
@@ -183,74 +189,702 @@ def hierarchy_pos(G, root, width=1.0, vert_gap=0.2, vert_loc=0, xcenter=0.5):
        vert_loc: vertical location of root
        xcenter: horizontal location of root
     '''
-    def h_recur(G, root, width, vert_gap, vert_loc, xcenter, pos=None, parent=None, parsed=[]):
+    def h_recur(G, root, width, vert_gap, vert_loc, xcenter, pos=None, parent=None, parsed=None):
+        if parsed is None:
+            parsed = set()
         if(root not in parsed):
-            parsed.append(root)
+            parsed.add(root)
             if pos == None:
                 pos = {root:(xcenter,vert_loc)}
             else:
                 pos[root] = (xcenter, vert_loc)
-            neighbors = G.neighbors(root)
-            if parent != None and parent in neighbors:
-                neighbors.remove(parent)
-            if len(neighbors)!=0:
-                dx = width/len(neighbors)
+            # Successors of a node in a directed graph don't include its parent
+            children = list(G.successors(root))
+            if len(children)!=0:
+                dx = width/len(children)
                 nextx = xcenter - width/2 - dx/2
-                for neighbor in neighbors:
+                for child in children:
                     nextx += dx
-                    pos = h_recur(G,neighbor, width = dx, vert_gap = vert_gap,
+                    pos = h_recur(G,child, width = dx, vert_gap = vert_gap,
                                         vert_loc = vert_loc-vert_gap, xcenter=nextx, pos=pos,
                                         parent = root, parsed = parsed)
         return pos
 
     return h_recur(G, root, width, vert_gap, vert_loc, xcenter)
 
+def load_bouts(s, p, path, offset=0, begin_with_stimuli=False, delim=';',
+        nheadrows=0, nomerge=False, max_rows=None, bout_file=None, text=False):
+    """Load CSV and collect stimuli and pause bouts. Unless behaviors should be
+    treated as text, the whole table is loaded as integer matrix. If this isn't
+    possible, behaviors are treated as text as well. If wanted, the merged bouts
+    are written out while loading, padded to match the original column counts.
+    Yields chunks of stimuli and pause bouts, either as integer matrices or as
+    lists of text bouts."""
+    if not text:
+        try:
+            bouts = load_int_bouts(s, p, path, offset, begin_with_stimuli,
+                    delim, nheadrows, nomerge, max_rows, bout_file)
+        except ValueError as e:
+            logger.warning("Could not load behaviors as integers, treating " \
+                    "them as text: {}".format(e))
+        else:
+            yield bouts
+            return
+
+    yield from load_text_bouts(s, p, path, offset, begin_with_stimuli, delim,
+            nheadrows, nomerge, max_rows, bout_file)
+
+def build_histograms(bout_chunks, marginal=False):
+    """Build the prefix histograms of stimuli and pause bouts from the bout
+    chunks yielded by load_bouts(). If <marginal> is set, the marginal
+    histograms of each bout position are built instead. Returns both histograms
+    along with the number of stimuli and pause bouts."""
+    make, add = (list, add_marginals) if marginal else (make_trie, add_bouts)
+    stimuli_histogram = make()
+    pause_histogram = make()
+    n_stimuli = 0
+    n_pauses = 0
+    for stimuli, pauses in bout_chunks:
+        add(stimuli_histogram, stimuli)
+        add(pause_histogram, pauses)
+        n_stimuli += len(stimuli)
+        n_pauses += len(pauses)
+    return stimuli_histogram, pause_histogram, n_stimuli, n_pauses
+
+def add_bouts(trie, bouts):
+    """Count the prefixes of an integer bout matrix or a list of text bouts in
+    <trie>. Integer bouts are counted in compiled code if available."""
+    if isinstance(bouts, np.ndarray):
+        make_histogram_arr(bouts, trie)
+    else:
+        make_histogram(bouts, trie)
+
+def add_marginals(marginals, bouts):
+    """Count how often each behavior occurs at each position of the bouts in
+    an integer bout matrix or a list of text bouts. <marginals> is a list with
+    a Counter for each position, which is extended if bouts are longer."""
+    if isinstance(bouts, np.ndarray):
+        columns = (bouts[:, position] for position in range(bouts.shape[1]))
+        for position, column in enumerate(columns):
+            behaviors, counts = np.unique(column[column != SENTINEL],
+                    return_counts=True)
+            # Columns after the first empty one only contain padding
+            if not len(behaviors):
+                break
+            if position == len(marginals):
+                marginals.append(Counter())
+            marginals[position].update(dict(zip(behaviors.tolist(),
+                    counts.tolist())))
+    else:
+        # Counting (position, behavior) pairs is done by Counter in C
+        pairs = Counter(chain.from_iterable(map(enumerate, bouts)))
+        for (position, b), count in pairs.items():
+            while position >= len(marginals):
+                marginals.append(Counter())
+            marginals[position][b] += count
+
+def bout_schedule(ncols, s, p, offset=0, begin_with_stimuli=False):
+    """Return a list of (start, length, is_stimuli) tuples for all complete
+    bouts that fit into a row with <ncols> columns."""
+    schedule = []
+    start = offset
+    stimuli_bout = begin_with_stimuli
+    while True:
+        length = s if stimuli_bout else p
+        if start + length > ncols:
+            break
+        schedule.append((start, length, stimuli_bout))
+        start += length
+        stimuli_bout = not stimuli_bout
+    return schedule
+
+def bout_getter(start, length):
+    """Return a function that extracts the <length> elements starting at
+    <start> from a row as tuple."""
+    if length == 1:
+        # An item getter for a single index doesn't return a tuple
+        return lambda row: (row[start],)
+    return itemgetter(*range(start, start + length))
+
+def load_text_bouts(s, p, path, offset=0, begin_with_stimuli=False,
+        delim=';', nheadrows=0, nomerge=False, max_rows=None, bout_file=None):
+    """Load stimuli and pause bouts, treating each behavior as string. Yields
+    chunks of stimuli bouts and pause bouts as lists. If <bout_file> is set, the
+    (padded) bouts of each row are written to it. If PyArrow is available, the
+    table is parsed in blocks and bouts are sliced out of each block column by
+    column. Once PyArrow can't parse the table anymore, e.g. because a row has
+    a different number of cells than the first one, the remaining rows are read
+    row by row, which is also done without PyArrow. Pandas isn't used, because
+    its chunked parser silently cuts long rows at the start of later chunks."""
+    with ExitStack() as stack:
+        boutwriter = None
+        if bout_file:
+            logger.info("Writing bout CSV file")
+            boutcsvfile = stack.enter_context(open(bout_file, 'w', newline='',
+                    buffering=1 << 20))
+            boutwriter = csv.writer(boutcsvfile, delimiter=delim,
+                    lineterminator='\n')
+
+        rows_seen = 0
+        if pac is not None:
+            try:
+                for table in read_arrow_text_tables(path, delim, nheadrows,
+                        max_rows):
+                    rows_seen += len(table)
+                    yield slice_text_bouts(table, s, p, offset,
+                            begin_with_stimuli, nomerge, boutwriter)
+                return
+            except ValueError as e:
+                logger.info("Could not parse table with PyArrow after {} rows: {}" \
+                        .format(rows_seen, e))
+
+        yield from read_text_bouts(s, p, path, offset, begin_with_stimuli,
+                delim, nheadrows + rows_seen, nomerge,
+                None if max_rows is None else max_rows - rows_seen, boutwriter)
+
+def read_arrow_text_tables(path, delim=';', nheadrows=0, max_rows=None):
+    """Parse the CSV file with PyArrow and yield it in blocks of rows as
+    tables of behavior strings. Raises a ValueError if a row has more or less
+    cells than the first one or if it only has empty cells, because PyArrow
+    reads blank lines, which have no bouts, as such rows."""
+    ncols = table_width(path, delim, nheadrows)
+    if not ncols:
+        raise ValueError("First row has no cells")
+    batches = arrow_batches(path, delim, nheadrows, max_rows, range(ncols),
+            pa.string())
+    for batch in batches:
+        table = np.empty((batch.num_rows, ncols), dtype=object)
+        for i, column in enumerate(batch.columns):
+            table[:, i] = column.to_numpy(zero_copy_only=False)
+        empty = table[table[:, 0] == '']
+        if (empty == '').all(axis=1).any():
+            raise ValueError("Table has blank lines or rows of empty cells")
+        yield table
+
+def slice_text_bouts(table, s, p, offset=0, begin_with_stimuli=False,
+        nomerge=False, boutwriter=None):
+    """Collect stimuli and pause bouts from a table of behavior strings. As
+    with the csv module, empty cells are behaviors like any other. If
+    <boutwriter> is set, the (padded) bouts of each row are written with it."""
+    schedule = bout_schedule(table.shape[1], s, p, offset, begin_with_stimuli)
+    logger.debug("Bout schedule: {}".format(schedule))
+    # All rows have the same number of cells, so every bout is complete
+    raw_stimuli = []
+    raw_pauses = []
+    bout_copies = []
+    for start, length, stimuli_bout in schedule:
+        block = table[:, start:(start + length)]
+
+        # Merge adjacent bout elements if they are the same, if not disabled.
+        # Only the first element of each run is kept and the kept elements are
+        # split into bouts again. Behaviors are interned, so that all bouts
+        # share the few distinct behavior strings.
+        if nomerge:
+            bouts = [tuple(map(sys.intern, bout)) for bout in block.tolist()]
+        else:
+            keep = np.empty(block.shape, dtype=bool)
+            keep[:, 0] = True
+            keep[:, 1:] = block[:, 1:] != block[:, :-1]
+            behaviors = map(sys.intern, block[keep].tolist())
+            bouts = [tuple(islice(behaviors, n)) for n in keep.sum(axis=1).tolist()]
+
+        if stimuli_bout:
+            raw_stimuli.extend(bouts)
+        else:
+            raw_pauses.extend(bouts)
+
+        if boutwriter:
+            bout_copies.append(bouts if nomerge else
+                    [pad_bout(bout, length) for bout in bouts])
+
+    if boutwriter:
+        # Bouts are written in their original order
+        columns = [[] for row in range(table.shape[0])]
+        for bouts in bout_copies:
+            for row, bout in zip(columns, bouts):
+                row.extend(bout)
+        boutwriter.writerows(columns)
+
+    return raw_stimuli, raw_pauses
+
+def read_text_bouts(s, p, path, offset=0, begin_with_stimuli=False,
+        delim=';', nheadrows=0, nomerge=False, max_rows=None, boutwriter=None):
+    """Read stimuli and pause bouts row by row, treating each behavior as
+    string. Yields the stimuli bouts and pause bouts of every CHUNK_ROWS rows as
+    lists, so that they can be counted before the next rows are read. If
+    <boutwriter> is set, the (padded) bouts of each row are written with it as
+    soon as the row is read."""
+    # Collected pause and stimuli bouts, indexed by the is_stimuli flag of the
+    # bout schedule, so that the bout type doesn't need to be checked per bout
+    raw_bouts = ([], [])
+    with open(path, 'r') as csvfile:
+        linereader = csv.reader(csvfile, delimiter=delim)
+        bout_label = "Bout" if nomerge else "Bout (merged)"
+        # Only build debug messages if they are actually logged
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # Bout schedules only depend on the row length. For each bout, a getter
+        # is created that extracts the bout as tuple from a row, along with
+        # the alias of its bout type for debug messages.
+        schedules = dict()
+        first = itemgetter(0)
+        intern = sys.intern
+
+        # Skip header rows and stop after <max_rows> data rows
+        next(islice(linereader, nheadrows, nheadrows), None)
+        rows = linereader if max_rows is None else islice(linereader, max_rows)
+
+        for n, row in enumerate(rows, 1):
+            # Prepare bout copying, if enabled
+            copy_target = [] if boutwriter else None
+
+            # Collect all bouts
+            schedule = schedules.get(len(row))
+            if schedule is None:
+                schedule = [(start, length, stimuli_bout, bout_getter(start, length),
+                        "S" if stimuli_bout else "P") for start, length, stimuli_bout
+                        in bout_schedule(len(row), s, p, offset, begin_with_stimuli)]
+                schedules[len(row)] = schedule
+            if debug:
+                logger.debug("Row: {}".format(row))
+            for start, length, stimuli_bout, getter, bout_alias in schedule:
+                raw_bout = getter(row)
+
+                # Merge adjacent bout elements if they are the same, if not
+                # disabled. This maps the groups to their keys without a
+                # Python level generator. The remaining behaviors are interned.
+                bout = tuple(map(intern, raw_bout if nomerge else
+                        map(first, groupby(raw_bout))))
+                if debug:
+                    logger.debug("{}: Bout start: {} bound end: {} {}: {}" \
+                            .format(bout_alias, start, start + length - 1, bout_label, ",".join(bout)))
+
+                raw_bouts[stimuli_bout].append(bout)
+
+                if boutwriter:
+                    bout_copy = bout if nomerge else pad_bout(bout, length)
+                    copy_target.append(bout_copy)
+
+            if boutwriter:
+                boutwriter.writerow(chain.from_iterable(copy_target))
+
+            if n % CHUNK_ROWS == 0:
+                yield raw_bouts[1], raw_bouts[0]
+                raw_bouts = ([], [])
+
+    yield raw_bouts[1], raw_bouts[0]
+
+def table_width(path, delim=';', nheadrows=0):
+    """Return the number of cells of the first data row of the CSV file."""
+    with open(path, 'r') as csvfile:
+        linereader = csv.reader(csvfile, delimiter=delim)
+        return len(next(islice(linereader, nheadrows, None), []))
+
+def arrow_batches(path, delim=';', nheadrows=0, max_rows=None, columns=(),
+        column_type=None):
+    """Parse the <columns> of the CSV file as <column_type> with PyArrow's
+    multithreaded parser. Yields record batches until <max_rows> rows have
+    been read. Empty cells are empty strings in text columns and null in all
+    others, blank lines are rows of empty cells. Raises a ValueError if the
+    file can't be parsed."""
+    names = ["f{}".format(i) for i in columns]
+    # PyArrow includes all columns if none are given. Without <columns>, only
+    # the first one is parsed as text and the batches keep just their rows.
+    column_types = {name: column_type for name in names} or {"f0": pa.string()}
+    reader = pac.open_csv(path,
+            read_options=pac.ReadOptions(skip_rows=nheadrows, use_threads=True,
+                    block_size=ARROW_BLOCK_SIZE, autogenerate_column_names=True),
+            parse_options=pac.ParseOptions(delimiter=delim,
+                    ignore_empty_lines=False),
+            convert_options=pac.ConvertOptions(include_columns=list(column_types),
+                    column_types=column_types, strings_can_be_null=False,
+                    null_values=['']))
+    with reader:
+        rows_left = max_rows
+        for batch in reader:
+            if rows_left is not None:
+                if rows_left <= 0:
+                    return
+                batch = batch.slice(0, rows_left)
+                rows_left -= batch.num_rows
+            yield batch if names else batch.select([])
+
+def load_arrow_int_table(path, delim=';', nheadrows=0, max_rows=None,
+        columns=()):
+    """Load the <columns> of the CSV file as int64 matrix with PyArrow. Raises a
+    ValueError if the table can't be parsed as integers."""
+    # Cells are parsed as text and only converted once the batches have been
+    # cut at <max_rows>, so that later rows can't make the conversion fail.
+    batches = list(arrow_batches(path, delim, nheadrows, max_rows, columns,
+            pa.string()))
+    table = np.empty((sum(batch.num_rows for batch in batches), len(columns)),
+            dtype=np.int64)
+    if batches and table.size:
+        columns = pa.Table.from_batches(batches).columns
+        for i, column in enumerate(columns):
+            values = pc.cast(column, pa.int64())
+            if not pc.all(pc.equal(pc.cast(values, pa.string()), column)).as_py():
+                raise ValueError("Behaviors aren't all spelled as integers")
+            table[:, i] = values.to_numpy()
+    return table
+
+def parse_int_cells(labels, ids):
+    """Convert a matrix of cells into an int64 matrix, given as the distinct
+    cell strings <labels> and the index of each cell's string in <ids>. Only
+    the labels are parsed, because tables have few distinct behaviors. Raises
+    a ValueError if a label isn't spelled exactly like its integer, e.g. 01 or
+    " 2", because such behaviors would lose their spelling."""
+    values = [int(label) for label in labels]
+    if any(str(value) != label for value, label in zip(values, labels)):
+        raise ValueError("Behaviors aren't all spelled as integers")
+    try:
+        return np.array(values, dtype=np.int64)[ids]
+    except OverflowError:
+        raise ValueError("Behaviors don't fit into int64")
+
+def load_int_table(path, delim=';', nheadrows=0, max_rows=None, offset=0):
+    """Load all columns starting at <offset> from the CSV file as int16 matrix.
+    PyArrow's or pandas' parser is used if available, otherwise the csv module.
+    Raises a ValueError if the table can't be parsed as integers, if a cell
+    isn't spelled exactly like its integer, if a value doesn't fit into an
+    int16 or if the rows don't all have the same number of cells as the first
+    one."""
+    ncols = table_width(path, delim, nheadrows)
+    if not ncols:
+        raise ValueError("First row has no cells")
+
+    if pac is not None:
+        # Columns before the first bout aren't converted at all
+        table = load_arrow_int_table(path, delim, nheadrows, max_rows,
+                range(offset, ncols))
+    elif pd is not None:
+        # Cells are read as text and converted by parse_int_cells(), because
+        # pandas wraps values that are out of range of the requested type and
+        # accepts floats like 1.0 as integers. Reading the whole table at once
+        # makes pandas raise on rows with more cells than the first one, and
+        # the missing cells of shorter rows are empty, which can't be parsed.
+        table = pd.read_csv(path, sep=delim, header=None, skiprows=nheadrows,
+                nrows=max_rows, dtype=str, keep_default_na=False,
+                skip_blank_lines=False, engine='c', memory_map=True)
+        cells = table.iloc[:, offset:].to_numpy()
+        ids, labels = pd.factorize(cells.ravel(), use_na_sentinel=False)
+        table = parse_int_cells(labels, ids.reshape(cells.shape))
+    else:
+        with open(path, 'r') as csvfile:
+            linereader = csv.reader(csvfile, delimiter=delim)
+            rows = list(islice(linereader, nheadrows, None if max_rows is None
+                    else nheadrows + max_rows))
+        if any(len(row) != ncols for row in rows):
+            raise ValueError("Rows have different numbers of cells")
+        cells = np.array([row[offset:] for row in rows], dtype=str) \
+                .reshape(len(rows), max(0, ncols - offset))
+        labels, ids = np.unique(cells, return_inverse=True)
+        table = parse_int_cells(labels.tolist(), ids.reshape(cells.shape))
+
+    limits = np.iinfo(np.int16)
+    if table.size and (table.min() < limits.min or table.max() > limits.max):
+        raise ValueError("Behaviors don't fit into {}".format(limits.dtype))
+    return table.astype(np.int16)
+
+def load_int_bouts(s, p, path, offset=0, begin_with_stimuli=False,
+        delim=';', nheadrows=0, nomerge=False, max_rows=None, bout_file=None):
+    """Load the whole CSV table as integer matrix and slice stimuli and pause
+    bouts out of it. Returns a matrix of stimuli bouts and a matrix of pause
+    bouts, one bout per row. Merged bouts are padded with SENTINEL. If
+    <bout_file> is set, the bouts are written to it, padded with zeros. Raises
+    a ValueError if a behavior isn't larger than SENTINEL."""
+    table = load_int_table(path, delim, nheadrows, max_rows, offset)
+    # SENTINEL ends bouts in integer matrices, so it can't be a behavior
+    if table.size and table.min() <= SENTINEL:
+        raise ValueError("Behaviors must be larger than {}".format(SENTINEL))
+    # Small behavior identifiers fit into a single byte, which reduces the
+    # memory that has to be moved while merging and counting.
+    if table.size and table.max() <= np.iinfo(np.int8).max:
+        table = table.astype(np.int8)
+    # The loaded table already starts with the first bout
+    schedule = bout_schedule(table.shape[1], s, p, 0, begin_with_stimuli)
+    logger.debug("Bout schedule: {}".format(schedule))
+
+    if s == p:
+        # With equal bout lengths, each row is a sequence of same sized bouts
+        # of alternating type.
+        blocks = table[:, :len(schedule) * s].reshape(table.shape[0],
+                len(schedule), s)
+        stimuli_mask = np.array([b[2] for b in schedule], dtype=bool)
+        stimuli_block = blocks[:, stimuli_mask]
+        pause_block = blocks[:, ~stimuli_mask]
+    else:
+        stimuli_starts = np.array([b[0] for b in schedule if b[2]], dtype=np.intp)
+        pause_starts = np.array([b[0] for b in schedule if not b[2]], dtype=np.intp)
+        stimuli_block = table[:, stimuli_starts[:,None] + np.arange(s)]
+        pause_block = table[:, pause_starts[:,None] + np.arange(p)]
+
+    # Merge adjacent bout elements if they are the same, if not disabled
+    if not nomerge:
+        stimuli_block = merge_bouts(stimuli_block)
+        pause_block = merge_bouts(pause_block)
+
+    if bout_file:
+        logger.info("Writing bout CSV file")
+        # Bouts are written in their original order
+        boutcsv = np.empty((table.shape[0], sum(b[1] for b in schedule)),
+                dtype=table.dtype)
+        n_stimuli_bouts = 0
+        n_pause_bouts = 0
+        column = 0
+        for start, length, stimuli_bout in schedule:
+            if stimuli_bout:
+                bout = stimuli_block[:, n_stimuli_bouts]
+                n_stimuli_bouts += 1
+            else:
+                bout = pause_block[:, n_pause_bouts]
+                n_pause_bouts += 1
+            boutcsv[:, column:(column + length)] = np.where(bout == SENTINEL, 0, bout)
+            column += length
+        np.savetxt(bout_file, boutcsv, fmt='%d', delimiter=delim)
+
+    return stimuli_block.reshape(-1, s), pause_block.reshape(-1, p)
+
+def merge_bouts(bouts):
+    """Merge adjacent same behaviors in each bout, i.e. each row of the last
+    axis of <bouts>. Merged bouts keep their shape, unused columns are set to
+    SENTINEL."""
+    # Find the first element of every run and its column in the merged bout
+    keep = np.empty(bouts.shape, dtype=bool)
+    keep[..., 0] = True
+    np.not_equal(bouts[..., 1:], bouts[..., :-1], out=keep[..., 1:])
+    columns = np.cumsum(keep, axis=-1) - 1
+
+    merged = np.full_like(bouts, SENTINEL)
+    kept = np.nonzero(keep)
+    merged[kept[:-1] + (columns[kept],)] = bouts[kept]
+    return merged
+
 def pad_bout(bout, length, pad_char="0"):
-    """Will add extra padding characters (default: 0) to the bout list if it is
+    """Will add extra padding characters (default: 0) to the bout tuple if it is
     shorter than the passed in length."""
     ldiff = length - len(bout)
     if ldiff > 0:
-        bout = bout + [pad_char] * ldiff
+        bout = bout + (pad_char,) * ldiff
     return bout
 
+def flatten_trie(trie):
+    """Store a prefix trie as array of TRIE_NODE records, in which the children
+    of each node are a contiguous run of nodes after their parent. Nodes are
+    ordered by the id of their parent, which puts children after their parents,
+    because parents are always created first. Returns the node array and the
+    list of behaviors the node labels refer to."""
+    counts, children = trie
+    n = len(counts)
+    order = np.zeros(n, dtype=np.intp)
+    order[1:] = np.fromiter(chain.from_iterable(map(dict.values, children)),
+            dtype=np.intp, count=n - 1)
+    nchild = np.fromiter(map(len, children), dtype=np.int32, count=n)
+    behaviors = list(chain.from_iterable(children))
+    labels = list(dict.fromkeys(behaviors))
+    label_ids = dict(zip(labels, range(len(labels))))
+
+    nodes = np.empty(n, dtype=TRIE_NODE)
+    nodes['count'] = np.asarray(counts, dtype=np.int64)[order]
+    nodes['nchild'] = nchild[order]
+    nodes['first'] = (np.cumsum(nchild) - nchild + 1)[order]
+    nodes['label'][0] = -1
+    nodes['label'][1:] = np.fromiter(map(label_ids.__getitem__, behaviors),
+            dtype=np.int32, count=n - 1)
+    return nodes, labels
+
 def percentage_tree(histogram):
-    def walk(nodes):
-        new_level = {}
-        # Get percentage of node count vs total count on this level
-        total = 0
-        for e,p in nodes.items():
-            total += p['count']
-        for e,p in nodes.items():
-            children = p.get('children')
-            new_children = walk(children) if children else {}
-            new_level[e] = {
-                'percent': p['count'] / total,
-                'count': p['count'],
-                'children': new_children
-            }
-        return new_level
-
-    return walk(histogram)
+    """Convert a prefix trie into a nested tree of nodes. Each node stores its
+    count, its percentage relative to its siblings and its children. The trie
+    is flattened first, which makes all siblings a contiguous run of nodes.
+    The percentages of all nodes are computed at once from the node counts, by
+    dividing each count by the total count of its run. The children of each
+    node are then a slice of the list of all tree nodes."""
+    nodes, labels = flatten_trie(histogram)
+    n = len(nodes)
+    # Get percentage of node count vs total count on its level. Runs of
+    # children are sorted by their first node, which gives each node's parent.
+    runs = np.argsort(nodes['first'], kind='stable')
+    parents = np.repeat(runs, nodes['nchild'][runs])
+    totals = np.bincount(parents, weights=nodes['count'][1:], minlength=n)
+    percents = [None] + (nodes['count'][1:] / totals[parents]).tolist()
+
+    tree_nodes = [{
+        'percent': percent,
+        'count': count,
+        'children': None
+    } for percent, count in zip(percents, nodes['count'].tolist())]
+    # Integer behaviors are spelled like in the table, as text behaviors are
+    labels = [str(label) for label in labels]
+    behaviors = [None] + [labels[label] for label in nodes['label'][1:].tolist()]
+    for node, first, nchild in zip(tree_nodes, nodes['first'].tolist(),
+            nodes['nchild'].tolist()):
+        end = first + nchild
+        node['children'] = dict(zip(behaviors[first:end], tree_nodes[first:end]))
+
+    return tree_nodes[0]['children']
+
+def marginal_percentages(marginals):
+    """Convert marginal histograms into a list with a dict for each bout
+    position. It maps each behavior to its count and its percentage relative
+    to all behaviors at this position."""
+    positions = []
+    for counts in marginals:
+        total = sum(counts.values())
+        positions.append({str(b): {
+            'percent': count / total,
+            'count': count
+        } for b, count in counts.items()})
+
+    return positions
 
 def format_histogram(histogram):
     return pprint.pformat(histogram)
 
-def make_histogram(bouts):
-    root = dict()
+def make_trie():
+    """Create an empty prefix trie, stored as two parallel lists indexed by node
+    id: the count of each node and a dict mapping the behaviors of a node's
+    children to their node ids. Node 0 is the root, its count isn't used."""
+    return [0], [dict()]
+
+def trie_child(trie, node, b):
+    """Return the id of the child of <node> for behavior <b>, which is added
+    if it doesn't exist yet."""
+    counts, children = trie
+    # A new child gets the next free node id, which needs only one lookup
+    child = children[node].setdefault(b, len(counts))
+    if child == len(counts):
+        counts.append(0)
+        children.append(dict())
+    return child
+
+def insert_bout(trie, bout, node=0):
+    """Count all prefixes of <bout> up to its first SENTINEL, starting at trie
+    node <node>."""
+    counts, children = trie
+    n_nodes = len(counts)
+    for b in bout:
+        if b == SENTINEL:
+            break
+        child = children[node].setdefault(b, n_nodes)
+        if child == n_nodes:
+            counts.append(1)
+            children.append(dict())
+            n_nodes += 1
+        else:
+            counts[child] += 1
+        node = child
+
+def make_histogram(bouts, trie=None):
+    """Count how often each bout prefix occurs. The result is a prefix trie, in
+    which the path from the root to a node is a sequence of behaviors and the
+    node's count is the number of bouts that start with this path. If <trie> is
+    given, the prefixes are added to it."""
+    if trie is None:
+        trie = make_trie()
     for bout in bouts:
-        parent = root
-        for b in bout:
-            node = parent.get(b)
-            if node is None:
-                node = {
-                    'count': 0,
-                    'children': dict()
-                }
-                parent[b] = node
-            node['count'] += 1
-            parent = node['children']
-
-    return root
+        insert_bout(trie, bout)
+
+    return trie
+
+def make_histogram_arr(bouts, trie=None):
+    """Like make_histogram(), but for a matrix of integer bouts, one bout per
+    row. Each bout ends at its first SENTINEL value. If the _bouttable Cython
+    extension has been built or Numba is available, the prefixes are counted in
+    compiled code. Large matrices are then split into chunks of at least
+    CHUNK_BOUTS bouts, which are counted in parallel threads."""
+    if trie is None:
+        trie = make_trie()
+    trie_counts = trie[0]
+    if _bouttable:
+        count = lambda chunk: _bouttable.count_prefixes(chunk, SENTINEL)
+    elif numba:
+        count = count_prefixes
+    else:
+        count = None
+
+    if count:
+        n_chunks = max(1, min(os.cpu_count() or 1, len(bouts) // CHUNK_BOUTS))
+        # Keep the prefix keys of each chunk exact
+        n_chunks = max(n_chunks, bouts.size // (MAX_KERNEL_SIZE // 2) + 1)
+        chunks = np.array_split(bouts, n_chunks)
+        with ThreadPoolExecutor(n_chunks) as pool:
+            partials = list(pool.map(count, chunks))
+        for counts, parents, symbols in partials:
+            # Parents are always created before their children
+            nodes = []
+            for count, parent, symbol in zip(counts.tolist(), parents.tolist(),
+                    symbols.tolist()):
+                node = trie_child(trie, nodes[parent] if parent >= 0 else 0, symbol)
+                trie_counts[node] += count
+                nodes.append(node)
+        return trie
+
+    # The first levels of the tree have only few distinct prefixes that are
+    # shared by many bouts. Count them level by level with np.bincount().
+    shallow_depth = min(SHALLOW_DEPTH, bouts.shape[1])
+    prefix_nodes = {(): 0}
+    for depth in range(shallow_depth):
+        alive = bouts[:, depth] != SENTINEL
+        behaviors = bouts[alive, depth].astype(np.intp)
+        if not len(behaviors):
+            break
+        prefixes, groups = np.unique(bouts[alive, :depth], axis=0,
+                return_inverse=True)
+        low = int(behaviors.min())
+        n_behaviors = int(behaviors.max()) - low + 1
+        counts = np.bincount(groups.reshape(-1) * n_behaviors + behaviors - low,
+                minlength=len(prefixes) * n_behaviors)
+        prefixes = [tuple(prefix) for prefix in prefixes.tolist()]
+        for index in np.flatnonzero(counts).tolist():
+            group, behavior = divmod(index, n_behaviors)
+            prefix = prefixes[group]
+            node = trie_child(trie, prefix_nodes[prefix], behavior + low)
+            trie_counts[node] += int(counts[index])
+            prefix_nodes[prefix + (behavior + low,)] = node
+
+    # Deeper prefixes are sparse, count them bout by bout
+    for bout in bouts.tolist():
+        prefix = tuple(bout[:shallow_depth])
+        if SENTINEL in prefix:
+            continue
+        insert_bout(trie, bout[shallow_depth:], prefix_nodes[prefix])
+
+    return trie
+
+if numba:
+    @numba.njit(cache=True, nogil=True)
+    def count_prefixes(bouts):
+        """Count all prefixes of the SENTINEL terminated bouts in the <bouts>
+        matrix. Each prefix is identified by its parent prefix and its last
+        behavior, which are combined into a 64-bit key. The matrix must have
+        less than MAX_KERNEL_SIZE elements. Returns three arrays that
+        contain for each prefix its count, the index of its parent prefix (-1
+        for the root) and its last behavior."""
+        nodes = numba.typed.Dict.empty(numba.types.uint64, numba.types.int64)
+        # There can't be more prefixes than bout elements
+        counts = np.zeros(bouts.size, dtype=np.int64)
+        parents = np.empty(bouts.size, dtype=np.int64)
+        symbols = np.empty(bouts.size, dtype=bouts.dtype)
+        n_nodes = 0
+        for i in range(bouts.shape[0]):
+            parent = -1
+            for j in range(bouts.shape[1]):
+                v = bouts[i, j]
+                if v == SENTINEL:
+                    break
+                key = (np.uint64(parent + 1) << np.uint64(32)) | \
+                        np.uint64(v & 0xffffffff)
+                if key in nodes:
+                    node = nodes[key]
+                else:
+                    node = n_nodes
+                    nodes[key] = node
+                    parents[node] = parent
+                    symbols[node] = v
+                    n_nodes += 1
+                counts[node] += 1
+                parent = node
+        return counts[:n_nodes], parents[:n_nodes], symbols[:n_nodes]
 
 def get_arg_parser():
     parser = argparse.ArgumentParser(description="calculate pattern"
@@ -271,6 +905,10 @@ def get_arg_parser():
             help="Limit the number of rows to read fom the input file")
     parser.add_argument("-bf", "--bout-file", type=str,
             help='Write out bouts to a new CSV file', default=None)
+    parser.add_argument("-t", "--text", action="store_true", default=False,
+            help="Treat behaviors as text instead of integer identifiers")
+    parser.add_argument("-m", "--marginal", action="store_true", default=False,
+            help="Count behaviors per bout position instead of bout prefixes")
     parser.add_argument("s", type=int, help="the number of stimuli columns")
     parser.add_argument("p", type=int, help="the number of pause columns")
     parser.add_argument("file", type=str, help="the CSV file to load")
@@ -289,4 +927,4 @@ if __name__ == '__main__':
 
     stats = BoutStatistics(args.s, args.p, args.file, args.offset,
             not args.stimuli_first, args.delim, args.head_rows, args.no_merge,
-            args.max_rows, args.bout_file)
+            args.max_rows, args.bout_file, args.text, args.marginal)
@@ -0,0 +1,313 @@
+"""Regression tests for bouttablestats. All table loaders and counting backends
+are compared with a plain reading of the table row by row with the csv module,
+which is how bouts were collected before loaders and backends were added. Run
+with: python -m unittest test_bouttablestats"""
+
+import csv
+import logging
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from contextlib import ExitStack
+from itertools import groupby, islice
+from unittest import mock
+
+import numpy as np
+
+import bouttablestats as bt
+
+PARSERS = ('pyarrow', 'pandas', 'csv')
+COUNTERS = ('cython', 'numba', 'python')
+
+# Patched into bouttablestats to split tables into many chunks and blocks
+SMALL_CHUNKS = {'CHUNK_ROWS': 3, 'CHUNK_BOUTS': 2, 'ARROW_BLOCK_SIZE': 64}
+
+def setUpModule():
+    # Falling back to text is expected in many tests
+    bt.logger.setLevel(logging.ERROR)
+
+def backends():
+    """Return all available combinations of a table parser and a counting
+    backend."""
+    modules = {'pyarrow': bt.pac, 'pandas': bt.pd, 'csv': csv,
+            'cython': bt._bouttable, 'numba': bt.numba, 'python': bt}
+    return [(parser, counter) for parser in PARSERS for counter in COUNTERS
+            if modules[parser] is not None and modules[counter] is not None]
+
+def restrict(stack, parser, counter, small_chunks=False):
+    """Make bouttablestats only use <parser> and <counter> until <stack> is
+    closed."""
+    disabled = []
+    if parser != 'pyarrow':
+        disabled.append('pac')
+    if parser == 'csv':
+        disabled.append('pd')
+    if counter != 'cython':
+        disabled.append('_bouttable')
+    if counter == 'python':
+        disabled.append('numba')
+    for name in disabled:
+        stack.enter_context(mock.patch.object(bt, name, None))
+    if small_chunks:
+        for name, value in SMALL_CHUNKS.items():
+            stack.enter_context(mock.patch.object(bt, name, value))
+
+def reference_bouts(path, s, p, offset=0, begin_with_stimuli=False, delim=';',
+        nheadrows=0, nomerge=False, max_rows=None):
+    """Collect stimuli and pause bouts row by row. Returns both lists of bouts
+    and the rows of the bout file."""
+    bouts = {True: [], False: []}
+    bout_rows = []
+    with open(path, 'r') as csvfile:
+        rows = islice(csv.reader(csvfile, delimiter=delim), nheadrows, None)
+        if max_rows is not None:
+            rows = islice(rows, max_rows)
+        for row in rows:
+            bout_row = []
+            start, stimuli_bout = offset, begin_with_stimuli
+            while True:
+                length = s if stimuli_bout else p
+                raw_bout = row[start:(start + length)]
+                if len(raw_bout) < length:
+                    break
+                bout = raw_bout if nomerge else [b for b, _ in groupby(raw_bout)]
+                bouts[stimuli_bout].append(bout)
+                bout_row.extend(bout + ['0'] * (length - len(bout)))
+                start += length
+                stimuli_bout = not stimuli_bout
+            bout_rows.append(bout_row)
+    return bouts[True], bouts[False], bout_rows
+
+def reference_tree(bouts):
+    """Build a nested {behavior: (count, percent, children)} tree of all bout
+    prefixes."""
+    counts = {}
+    for bout in bouts:
+        node = counts
+        for b in bout:
+            child = node.setdefault(b, [0, {}])
+            child[0] += 1
+            node = child[1]
+
+    def percentages(node):
+        total = sum(count for count, _ in node.values())
+        return {b: (count, count / total, percentages(children))
+                for b, (count, children) in node.items()}
+    return percentages(counts)
+
+def reference_marginals(bouts):
+    """Count the behaviors at each bout position, as {behavior: (count,
+    percent)} per position."""
+    positions = []
+    for bout in bouts:
+        for i, b in enumerate(bout):
+            if i == len(positions):
+                positions.append({})
+            positions[i][b] = positions[i].get(b, 0) + 1
+    return [{b: (count, count / sum(counts.values()))
+            for b, count in counts.items()} for counts in positions]
+
+def tree(ptree):
+    """Convert a percentage tree of BoutStatistics like reference_tree()."""
+    return {b: (node['count'], node['percent'], tree(node['children']))
+            for b, node in ptree.items()}
+
+def marginals(positions):
+    return [{b: (node['count'], node['percent']) for b, node in counts.items()}
+            for counts in positions]
+
+def random_table(rng):
+    """Create the text of a random CSV table. Tables are integer or text
+    tables, may be ragged and may have cells that integer loaders have to
+    reject or keep."""
+    integers = rng.random() < 0.6
+    ncols = rng.randint(1, 12)
+    ragged = rng.random() < 0.5
+    special = rng.random() < 0.5
+    lines = []
+    for row in range(rng.randint(1, 14)):
+        if ragged and rng.random() < 0.05:
+            lines.append('')
+            continue
+        width = max(1, ncols + rng.randint(-4, 4)) if ragged else ncols
+        cells = []
+        for col in range(width):
+            r = rng.random() if special else 1.0
+            if r < 0.03:
+                cells.append('')
+            elif r < 0.06:
+                cells.append(rng.choice(['NA', 'null', 'nan', 'N/A']))
+            elif r < 0.09:
+                cells.append(rng.choice(['-1', '40000', '70000', '127', '128',
+                        '01', ' 2', '1.0', '+1', '-0']))
+            elif integers:
+                cells.append(str(rng.randint(0, 3)))
+            else:
+                cells.append(rng.choice('abc'))
+        lines.append(';'.join(cells))
+    return '\n'.join(lines) + '\n'
+
+
+class BoutTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.n_files = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_table(self, text):
+        self.n_files += 1
+        path = os.path.join(self.tmpdir, 'table{}.csv'.format(self.n_files))
+        with open(path, 'w') as csvfile:
+            csvfile.write(text)
+        return path
+
+    def run_statistics(self, parser, counter, path, s, p, small_chunks=False,
+            **kwargs):
+        """Run BoutStatistics with only <parser> and <counter>. Returns both
+        trees and the rows of the bout file."""
+        bout_file = os.path.join(self.tmpdir, 'bouts.csv')
+        with ExitStack() as stack:
+            restrict(stack, parser, counter, small_chunks)
+            stats = bt.BoutStatistics(s, p, path, bout_file=bout_file, **kwargs)
+        with open(bout_file, 'r') as csvfile:
+            bout_rows = list(csv.reader(csvfile, delimiter=kwargs.get('delim', ';')))
+        return tree(stats.stimuli_ptree), tree(stats.pause_ptree), bout_rows
+
+    def assertMatchesReference(self, text, s, p, small_chunks=False, **kwargs):
+        """Check that all backends count the bouts of the table <text> like
+        the reference, with and without treating behaviors as text. Returns
+        the reference trees of stimuli and pause bouts."""
+        path = self.write_table(text)
+        stimuli, pauses, bout_rows = reference_bouts(path, s, p, **kwargs)
+        expected = reference_tree(stimuli), reference_tree(pauses), bout_rows
+        for parser, counter in backends():
+            for as_text in (False, True):
+                with self.subTest(table=text, parser=parser, counter=counter,
+                        text=as_text, **kwargs):
+                    result = self.run_statistics(parser, counter, path, s, p,
+                            small_chunks, text=as_text, **kwargs)
+                    self.assertEqual(result, expected)
+        return expected[:2]
+
+
+class TestEquivalence(BoutTableTestCase):
+
+    def test_random_tables(self):
+        rng = random.Random(1)
+        for i in range(60):
+            text = random_table(rng)
+            kwargs = dict(offset=rng.choice([0, 0, 1, 2, 5]),
+                    begin_with_stimuli=rng.random() < 0.5,
+                    nheadrows=rng.choice([0, 0, 1]),
+                    nomerge=rng.random() < 0.3,
+                    max_rows=rng.choice([None, None, 2, 5]))
+            self.assertMatchesReference(text, rng.randint(1, 4),
+                    rng.randint(1, 4), small_chunks=rng.random() < 0.5, **kwargs)
+
+    def test_marginals(self):
+        text = '1;2;2;3;1;1\n2;2;1;3;3;1\n1;1;1;2;3;3\na;1;2;2;3;1\n'
+        path = self.write_table(text)
+        stimuli, pauses, _ = reference_bouts(path, 2, 4)
+        for parser, counter in backends():
+            for as_text in (False, True):
+                with self.subTest(parser=parser, counter=counter, text=as_text):
+                    with ExitStack() as stack:
+                        restrict(stack, parser, counter)
+                        stats = bt.BoutStatistics(2, 4, path, text=as_text,
+                                marginal=True)
+                    self.assertEqual(marginals(stats.stimuli_marginals),
+                            reference_marginals(stimuli))
+                    self.assertEqual(marginals(stats.pause_marginals),
+                            reference_marginals(pauses))
+
+    def test_prefix_kernels(self):
+        # Many distinct prefixes, to catch prefixes that share a key
+        rng = np.random.default_rng(2)
+        for dtype in (np.int8, np.int16):
+            high = np.iinfo(dtype).max
+            bouts = rng.integers(0, high, size=(20000, 6), endpoint=True,
+                    dtype=dtype)
+            ends = rng.integers(1, bouts.shape[1], size=bouts.shape[0],
+                    endpoint=True)
+            bouts[np.arange(bouts.shape[1]) >= ends[:, None]] = bt.SENTINEL
+            expected = tree(bt.percentage_tree(bt.make_histogram(bouts.tolist())))
+            for counter in {counter for parser, counter in backends()}:
+                with self.subTest(dtype=dtype, counter=counter), ExitStack() as stack:
+                    restrict(stack, 'csv', counter, small_chunks=True)
+                    trie = bt.make_histogram_arr(bouts)
+                    self.assertEqual(tree(bt.percentage_tree(trie)), expected)
+
+
+class TestRegressions(BoutTableTestCase):
+
+    def test_out_of_range_integers(self):
+        stimuli, pauses = self.assertMatchesReference(
+                '40000;1;70000;1\n1;40000;2;2\n', 2, 2)
+        self.assertIn('40000', pauses)
+
+    def test_negative_behaviors(self):
+        stimuli, pauses = self.assertMatchesReference('-1;1;2;2\n1;1;-2;2\n', 2, 2)
+        self.assertIn('-1', pauses)
+
+    def test_integral_floats(self):
+        text = '1.0;1;2;2\n1;1.0;2;2\n1;2;2;2\n'
+        for max_rows in (None, 3):
+            stimuli, pauses = self.assertMatchesReference(text, 2, 2,
+                    max_rows=max_rows)
+            self.assertEqual(set(pauses), {'1.0', '1'})
+
+    def test_integer_spelling(self):
+        stimuli, pauses = self.assertMatchesReference('01;1;2;2\n1; 2;2;2\n',
+                2, 2)
+        self.assertEqual(set(pauses), {'01', '1'})
+        self.assertIn(' 2', pauses['1'][2])
+
+    def test_null_like_behaviors(self):
+        stimuli, pauses = self.assertMatchesReference(
+                'NA;null;nan;N/A\nN/A;nan;null;NA\n', 1, 1)
+        self.assertEqual(set(pauses), {'NA', 'nan', 'N/A', 'null'})
+
+    def test_empty_cells(self):
+        self.assertMatchesReference('1;;2;2\n;;1;1\n1;1;;2\n', 2, 2)
+        self.assertMatchesReference('a;;b;b\n;;a;a\n', 1, 1, nomerge=True)
+        self.assertMatchesReference('\n;\n;a\n', 1, 1)
+
+    def test_blank_lines(self):
+        self.assertMatchesReference('1;2;2\n\n2;1;1\n', 1, 2)
+        self.assertMatchesReference('\n1;2;2\n2;1;1\n', 1, 2)
+        self.assertMatchesReference('a\n\nb\n', 1, 1, nheadrows=1)
+
+    def test_long_rows_after_chunk_start(self):
+        rows = ['1;2;1;2'] * 40 + ['1;2;1;2;3;3;3;3;2;2'] + ['2;1;2;1'] * 10
+        for small_chunks in (False, True):
+            self.assertMatchesReference('\n'.join(rows) + '\n', 2, 2,
+                    small_chunks=small_chunks)
+
+    def test_short_rows(self):
+        self.assertMatchesReference('1;2;1;2\n1;2\n2;1;2;1\n', 2, 2)
+        self.assertMatchesReference('a;b;a;b\na;b\nb;a;b;a\n', 2, 2)
+
+    def test_offset_past_row_width(self):
+        stimuli, pauses = self.assertMatchesReference('1;2;3\n3;2;1\n', 1, 1,
+                offset=3)
+        self.assertEqual((stimuli, pauses), ({}, {}))
+        self.assertMatchesReference('a;b;c\nc;b;a\n', 1, 1, offset=5)
+        self.assertMatchesReference('1;2;3\n3;2;1;1;2;3;1\n', 1, 1, offset=4)
+
+    def test_rows_after_max_rows(self):
+        self.assertMatchesReference('1;2;1;2\n2;1;2;1\na;b;a\n', 2, 2,
+                max_rows=2)
+        self.assertMatchesReference('1;2;1;2\n2;1;2;1\n1;b;a\n', 2, 2,
+                max_rows=2, nheadrows=1)
+
+    def test_header_rows_only(self):
+        self.assertMatchesReference('a;b;c\n', 1, 1, nheadrows=1)
+
+
+if __name__ == '__main__':
+    unittest.main()